@@ -3,43 +3,70 @@ from __future__ import annotations
 import sys
 import os
 import argparse
+import asyncio
+import mmap
 from pathlib import Path
 # Standard library
-from typing import Iterator, Optional
-import io
+from typing import Callable, Iterator, NoReturn, Optional
+from urllib.parse import urlparse
+import queue
 import threading
+import traceback
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 
 # Third-party libraries
-import csv
-
 import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
 import pyarrow.parquet as pq
 
+# ConnectorX and the MCP SDK are resolved once here; main() reports a missing one at startup
+try:
+  import connectorx as cx  # type: ignore
+  import mcp.server.stdio  # type: ignore
+  import mcp.types as types  # type: ignore
+  from mcp.server import NotificationOptions, Server  # type: ignore
+  from mcp.server.models import InitializationOptions  # type: ignore
+except ImportError as _exc:
+  _IMPORT_ERROR: Optional[ImportError] = _exc
+else:
+  _IMPORT_ERROR = None
+
 
 DOC_USAGE = """
-MCP Server: ConnectorX → CSV/Parquet (RecordBatch streaming)
+MCP Server: ConnectorX → CSV/Parquet/Arrow IPC (RecordBatch streaming)
 
 Purpose:
   Provide an MCP tool (run_sql) that executes an arbitrary SQL statement via ConnectorX
-  and streams the result to CSV or Parquet in RecordBatch chunks.
+  and streams the result to CSV, Parquet, or Arrow IPC (Feather V2) in RecordBatch chunks.
 
 How to start the server:
   uvx run-sql-connectorx \
-    --conn <connection_token>
+    --conn <connection_token> \
+    [--csv-token-threshold <int>] [--detach-batches]
 
 Exposed MCP tool: run_sql
   Parameters:
     sql_file (str)       – Path to a file that contains the SQL to execute
     output_path (str)    – Destination file path for the result
-    output_format (str)  – Either "csv" or "parquet"
+    output_format (str)  – One of "csv", "parquet", or "arrow" (Arrow IPC file / Feather V2)
     batch_size (int)     – Optional RecordBatch size (default 100000)
+    partition_on (str)   – Optional column used to split the query across parallel connections
+    partition_num (int)  – Optional number of partitions (used together with partition_on)
+
+  Partitioned reads:
+    With partition_on and partition_num, ConnectorX splits the query into partition_num range
+    queries on that column and runs them on parallel connections. Pick a numeric column without
+    NULLs whose values are spread evenly (a monotonic integer key such as an id is ideal), and
+    a partition_num no larger than the connections the database allows. Ignored for BigQuery.
 """
 
 
 # -------- CLI / server bootstrap --------
 
 def _parse_args() -> argparse.Namespace:
-  parser = argparse.ArgumentParser(description="MCP Server: ConnectorX -> CSV/Parquet (RecordBatch streaming)")
+  parser = argparse.ArgumentParser(description="MCP Server: ConnectorX -> CSV/Parquet/Arrow IPC (RecordBatch streaming)")
 
   parser.add_argument("--conn", required=True, help="ConnectorX connection token (server-wide, fixed)")
   parser.add_argument(
@@ -48,237 +75,626 @@ def _parse_args() -> argparse.Namespace:
     default=0,
     help="When >0, count CSV tokens using tiktoken(o200k_base) and report total; value acts as a warning threshold",
   )
+  parser.add_argument(
+    "--detach-batches",
+    action="store_true",
+    help="Copy each ConnectorX batch into PyArrow-owned memory so ConnectorX buffers are released immediately",
+  )
 
   return parser.parse_args()
 
 
+# -------- cache-aware sizing --------
+
+def _l2_cache_bytes() -> int:
+  try:
+    size = os.sysconf("SC_LEVEL2_CACHE_SIZE")
+  except (AttributeError, ValueError, OSError):
+    size = 0
+  return size if size > 0 else 262144
+
+
+_L2_CACHE_BYTES = _l2_cache_bytes()
+
+
+def _cache_aware_rows(batch: pa.RecordBatch, batch_size: int) -> int:
+  """Number of rows to encode at a time so that one chunk stays resident in L2.
+
+  Encoding throughput drops once the working set spills out of L2, so the chunk is sized
+  from the average row width measured on ``batch`` (its Arrow buffer bytes per row). For an
+  empty batch the width is estimated from the schema instead, assuming 32 bytes for
+  variable-width columns. The result is capped at ``batch_size`` but never below 1024 rows,
+  to keep per-chunk overhead amortized.
+  """
+  if batch.num_rows > 0:
+    bytes_per_row = batch.nbytes // batch.num_rows
+  else:
+    bytes_per_row = 0
+    for field in batch.schema:
+      try:
+        bytes_per_row += max(field.type.bit_width // 8, 1)
+      except ValueError:  # variable-width type
+        bytes_per_row += 32
+  return max(1024, min(batch_size, _L2_CACHE_BYTES // max(bytes_per_row, 1)))
+
+
 # -------- batch writers --------
 
+# Output files are written through a large user-space buffer so that multi-GB results turn
+# into few, large write() calls (matters most on network-mounted output paths).
+_OUTPUT_BUFFER_BYTES = 1 << 22
+
+
+def _open_output(output_path: Path, mode: str) -> pa.BufferedOutputStream:
+  return pa.BufferedOutputStream(pa.OSFile(str(output_path), mode), buffer_size=_OUTPUT_BUFFER_BYTES)
+
+
+def _is_binary_type(data_type: pa.DataType) -> bool:
+  if pa.types.is_dictionary(data_type):
+    data_type = data_type.value_type
+  return (
+    pa.types.is_binary(data_type)
+    or pa.types.is_large_binary(data_type)
+    or pa.types.is_fixed_size_binary(data_type)
+    # binary_view only exists from pyarrow 16
+    or getattr(pa.types, "is_binary_view", lambda _: False)(data_type)
+  )
+
+
+def _csv_writable(schema: pa.Schema) -> bool:
+  try:
+    pacsv.CSVWriter(pa.BufferOutputStream(), schema, write_options=pacsv.WriteOptions(include_header=False)).close()
+  except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+    return False
+  return True
+
+
+def _csv_unsupported_columns(schema: pa.Schema) -> list[int]:
+  """Indices of the columns pyarrow.csv cannot format (lists, structs, maps, binary, ...).
+
+  Binary columns are always included: the CSV writer renders them only when every value
+  happens to be valid UTF-8, so whether a batch fails would otherwise depend on the data.
+  Other types are probed by opening a writer on a throw-away sink, which rejects
+  unsupported types up front; the whole schema is tried first so the common case costs
+  a single probe.
+  """
+  unsupported = [i for i, field in enumerate(schema) if _is_binary_type(field.type)]
+  if not _csv_writable(schema):
+    unsupported = [
+      i for i, field in enumerate(schema)
+      if i in unsupported or not _csv_writable(pa.schema([field]))
+    ]
+  return unsupported
+
+
+def _format_csv_column(column: pa.Array) -> pa.Array:
+  # Same text as the csv.writer path produced: str() of each value, nulls as empty fields
+  return pa.array([None if v is None else str(v) for v in column.to_pylist()], type=pa.string())
+
+
+def _cast_csv_column(column: pa.Array) -> pa.Array:
+  return pc.cast(column, pa.string())
+
+
+def _csv_column_converters(schema: pa.Schema) -> dict[int, Callable[[pa.Array], pa.Array]]:
+  """Pick how each column pyarrow.csv cannot format is rendered to strings.
+
+  Where Arrow has a cast to string (e.g. string_view) the whole column is cast in C++;
+  only the rest (lists, structs, maps, binary) goes through _format_csv_column. Binary is
+  never cast: the cast fails on values that are not valid UTF-8.
+  """
+  converters: dict[int, Callable[[pa.Array], pa.Array]] = {}
+  for i in _csv_unsupported_columns(schema):
+    data_type = schema.field(i).type
+    converter = _format_csv_column
+    if not _is_binary_type(data_type):
+      try:
+        pc.cast(pa.array([], type=data_type), pa.string())
+        converter = _cast_csv_column
+      except (pa.ArrowInvalid, pa.ArrowNotImplementedError, TypeError):
+        pass
+    converters[i] = converter
+  return converters
+
+
 def _write_csv_batches(
-  header: list[str],
   batches: Iterator[pa.RecordBatch],
   output_path: Path,
-  encoder: Optional[object] = None,
-) -> int:
-  """Write CSV in streaming fashion; optionally count tokens of each written line.
+  batch_size: int,
+) -> None:
+  """Write CSV in streaming fashion via Arrow's C++ CSV writer.
+
+  Each RecordBatch is formatted by pyarrow.csv directly from its Arrow buffers; rows are
+  converted in L2-sized chunks (see _cache_aware_rows). Only columns the CSV writer cannot
+  format are first rendered to strings (see _csv_column_converters). The file is always
+  truncated and starts with the header row.
+  """
+  writer: Optional[pacsv.CSVWriter] = None
+  convert: dict[int, Callable[[pa.Array], pa.Array]] = {}
+
+  with _open_output(output_path, "wb") as sink:
+    try:
+      for batch in batches:
+        if writer is None:
+          convert = _csv_column_converters(batch.schema)
+          schema = batch.schema
+          for i in convert:
+            schema = schema.set(i, pa.field(schema.field(i).name, pa.string()))
+          options = pacsv.WriteOptions(include_header=True, batch_size=_cache_aware_rows(batch, batch_size))
+          writer = pacsv.CSVWriter(sink, schema, write_options=options)
+        if convert:
+          columns = list(batch.columns)
+          for i, converter in convert.items():
+            columns[i] = converter(columns[i])
+          batch = pa.RecordBatch.from_arrays(columns, schema=schema)
+          del columns
+        writer.write_batch(batch)
+        # Drop the reference now so the batch's buffers are freed before the next one arrives
+        del batch
+    finally:
+      if writer is not None:
+        writer.close()
+
+
+# tiktoken encodings by name; loading one parses the BPE ranks, so do it once per process
+_ENCODER_CACHE: dict[str, object] = {}
+
+
+def _get_encoder(name: str) -> object:
+  encoder = _ENCODER_CACHE.get(name)
+  if encoder is None:
+    import tiktoken  # type: ignore
+    encoder = _ENCODER_CACHE[name] = tiktoken.get_encoding(name)
+  return encoder
+
 
-  When an encoder is provided (tiktoken Encoding), count tokens for each formatted CSV line
-  including delimiters, quotes, and line terminators as produced by csv.writer.
+# Size of the newline-aligned pieces the written CSV is split into for token counting
+_TOKEN_CHUNK_BYTES = 1 << 20
+
+# Token-counting threads; capped because each in-flight piece holds its token ids in memory
+_TOKEN_COUNT_WORKERS = min(os.cpu_count() or 1, 8)
+
+
+def _count_csv_tokens(output_path: Path, encoder: object) -> int:
+  """Count tokens of a written CSV file in parallel.
+
+  The file is memory-mapped and cut into ~1 MiB pieces that end on a newline (always a
+  valid UTF-8 boundary). One thread pool serves the whole file; each task decodes and
+  tokenizes a single piece (tiktoken releases the GIL while encoding) and returns only its
+  token count. At most two pieces per worker are in flight, so memory stays bounded for
+  multi-GB files regardless of the core count.
   """
+  size = output_path.stat().st_size
+  if size == 0:
+    return 0
+  workers = _TOKEN_COUNT_WORKERS
   tokens_total = 0
-  header_written = output_path.exists() and output_path.stat().st_size > 0
-
-  def _line_tokens(values: list[object]) -> int:
-    if encoder is None:
-      return 0
-    buf = io.StringIO(newline="")
-    tmp_writer = csv.writer(buf)
-    tmp_writer.writerow(values)
-    line = buf.getvalue()
-    # Lazy import typing for type hints avoided; encoder is a tiktoken Encoding-like object
-    return len(encoder.encode(line))  # type: ignore[attr-defined]
-
-  with output_path.open("a", newline="", encoding="utf-8") as fp:
-    writer = csv.writer(fp)
-    for batch in batches:
-      table = pa.Table.from_batches([batch])
-      if not header_written:
-        writer.writerow([col for col in table.schema.names])
-        tokens_total += _line_tokens([col for col in table.schema.names])
-        header_written = True
-      for row_idx in range(table.num_rows):
-        row = [table.column(col_idx)[row_idx].as_py() for col_idx in range(table.num_columns)]
-        writer.writerow(row)
-        tokens_total += _line_tokens(row)
+  with output_path.open("rb") as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+      ThreadPoolExecutor(max_workers=workers) as pool:
+
+    def _count(start: int, end: int) -> int:
+      # encoder is a tiktoken Encoding-like object
+      return len(encoder.encode_ordinary(mm[start:end].decode("utf-8")))  # type: ignore[attr-defined]
+
+    pending: deque[Future[int]] = deque()
+    start = 0
+    while start < size:
+      end = min(start + _TOKEN_CHUNK_BYTES, size)
+      if end < size:
+        nl = mm.rfind(b"\n", start, end)
+        if nl == -1:
+          nl = mm.find(b"\n", end)
+        end = size if nl == -1 else nl + 1
+      if len(pending) >= 2 * workers:
+        tokens_total += pending.popleft().result()
+      pending.append(pool.submit(_count, start, end))
+      start = end
+    tokens_total += sum(f.result() for f in pending)
   return tokens_total
 
 
-def _write_parquet_batches(batches: Iterator[pa.RecordBatch], output_path: Path) -> None:
+# Target in-memory size of one Parquet row group; batches are accumulated up to this size
+_PARQUET_ROW_GROUP_BYTES = 128 << 20
+
+
+def _write_parquet_batches(
+  batches: Iterator[pa.RecordBatch],
+  output_path: Path,
+  batch_size: int,
+) -> None:
+  """Write Parquet in streaming fashion with row groups of about 128 MiB.
+
+  ParquetWriter starts a new row group on every write call, so writing each ConnectorX
+  batch directly would tie row-group size to ``batch_size``. Instead batches are collected
+  until they reach _PARQUET_ROW_GROUP_BYTES of Arrow memory and written as one row group,
+  which keeps row groups large enough for efficient reads regardless of batch size.
+  Columns are ZSTD-compressed (level 3) with 1 MiB data pages. ParquetWriter itself rejects
+  a batch whose schema differs from the first one, so no extra per-batch check is done here.
+  """
   writer: Optional[pq.ParquetWriter] = None
-  try:
-    for batch in batches:
-      table = pa.Table.from_batches([batch])
-      if writer is None:
-        writer = pq.ParquetWriter(where=str(output_path), schema=table.schema)
-      else:
-        if not table.schema.equals(writer.schema):
-          raise RuntimeError("Schema mismatch across record batches")
-      writer.write_table(table)
-  finally:
-    if writer is not None:
-      writer.close()
+  pending: list[pa.RecordBatch] = []
+  pending_bytes = 0
+
+  def _flush() -> None:
+    nonlocal pending_bytes
+    table = pa.Table.from_batches(pending)
+    pending.clear()
+    pending_bytes = 0
+    writer.write_table(table, row_group_size=max(table.num_rows, 1))  # type: ignore[union-attr]
+
+  with _open_output(output_path, "wb") as sink:
+    try:
+      for batch in batches:
+        if writer is None:
+          writer = pq.ParquetWriter(
+            where=sink,
+            schema=batch.schema,
+            compression="zstd",
+            compression_level=3,
+            use_dictionary=True,
+            data_page_size=1 << 20,
+            write_batch_size=_cache_aware_rows(batch, batch_size),
+          )
+        pending.append(batch)
+        pending_bytes += batch.nbytes
+        del batch
+        if pending_bytes >= _PARQUET_ROW_GROUP_BYTES:
+          _flush()
+      if pending:
+        _flush()
+    finally:
+      if writer is not None:
+        writer.close()
+
+
+def _write_arrow_batches(batches: Iterator[pa.RecordBatch], output_path: Path) -> None:
+  """Write an Arrow IPC file (Feather V2) in streaming fashion.
+
+  Batches are written as-is from Arrow memory: no encoding or compression step, so the
+  cost is essentially a buffer copy to disk and readers can memory-map the result.
+  """
+  writer: Optional[pa.ipc.RecordBatchFileWriter] = None
+  with _open_output(output_path, "wb") as sink:
+    try:
+      for batch in batches:
+        if writer is None:
+          writer = pa.ipc.new_file(sink, batch.schema)
+        writer.write_batch(batch)
+        del batch
+    finally:
+      if writer is not None:
+        writer.close()
 
 
 # -------- shared error handling --------
 
-def _handle_connectorx_error(error_msg: str, vendor: str) -> None:
-  """Re-raise ConnectorX errors as RuntimeError without altering the original message."""
+def _handle_connectorx_error(error_msg: str, vendor: str) -> NoReturn:
+  """Re-raise ConnectorX errors as RuntimeError without altering the original message.
+
+  Never returns, so callers can rely on code after the call being unreachable.
+  """
   raise RuntimeError(error_msg)
 
 
 # -------- native stderr capture (to collect Rust panic output) --------
 
+# fd 2 is process-wide: captures must not interleave, or they would unwind out of order
+_STDERR_CAPTURE_LOCK = threading.Lock()
+
+# Seconds __exit__ waits for the drainer to reach EOF
+_STDERR_DRAIN_TIMEOUT = 1.0
+
+
 class _StderrCapture:
+  """Redirect fd 2 into a pipe for the duration of a ConnectorX query.
+
+  A drainer thread empties the pipe 64 KiB at a time, so writers never block on a full pipe
+  however much is printed (RUST_LOG, RUST_BACKTRACE=full). Each chunk is kept for get_text()
+  and also forwarded to the original stderr: fd 2 is process-wide, so output from other
+  threads during the capture still reaches the log instead of being discarded. Call
+  get_text() after the block has exited. At most one capture is active per process.
+  """
+
   def __init__(self) -> None:
     self._orig_fd: Optional[int] = None
     self._read_fd: Optional[int] = None
     self._write_fd: Optional[int] = None
-    self._buffer: list[bytes] = []
     self._thread: Optional[threading.Thread] = None
-    self._stop_event = threading.Event()
+    self._buffer = bytearray()
 
   def __enter__(self) -> "_StderrCapture":
-    self._orig_fd = os.dup(2)
-    self._read_fd, self._write_fd = os.pipe()
-    os.dup2(self._write_fd, 2)
-
-    def _reader() -> None:
-      try:
-        while not self._stop_event.is_set():
-          try:
-            chunk = os.read(self._read_fd, 4096)  # type: ignore[arg-type]
-          except OSError:
-            break
-          if not chunk:
-            break
-          self._buffer.append(chunk)
-      finally:
-        pass
-
-    self._thread = threading.Thread(target=_reader, daemon=True)
-    self._thread.start()
+    _STDERR_CAPTURE_LOCK.acquire()
+    try:
+      self._orig_fd = os.dup(2)
+      self._read_fd, self._write_fd = os.pipe()
+      thread = threading.Thread(target=self._drain, args=(self._read_fd, self._orig_fd), daemon=True)
+      thread.start()
+      self._thread = thread
+      os.dup2(self._write_fd, 2)
+    except BaseException:
+      self.__exit__(None, None, None)
+      raise
     return self
 
   def __exit__(self, exc_type, exc, tb) -> None:  # type: ignore[override]
     try:
+      if self._orig_fd is not None:
+        os.dup2(self._orig_fd, 2)
       if self._write_fd is not None:
         try:
           os.close(self._write_fd)
         except OSError:
           pass
-      self._stop_event.set()
+      # With the write end closed the drainer reaches EOF after the last chunk. The wait is
+      # bounded (and the lock released) in case something else still holds the write end,
+      # e.g. a child process that inherited fd 2; the drainer then finishes on its own.
       if self._thread is not None:
-        self._thread.join(timeout=0.5)
-      if self._orig_fd is not None:
-        try:
-          os.dup2(self._orig_fd, 2)
-        finally:
-          try:
-            os.close(self._orig_fd)
-          except OSError:
-            pass
-      if self._read_fd is not None:
-        try:
-          os.close(self._read_fd)
-        except OSError:
-          pass
+        self._thread.join(timeout=_STDERR_DRAIN_TIMEOUT)
     finally:
+      if self._thread is None:
+        # The drainer never started; otherwise it owns (and closes) these two
+        for fd in (self._read_fd, self._orig_fd):
+          if fd is not None:
+            try:
+              os.close(fd)
+            except OSError:
+              pass
       self._orig_fd = None
       self._read_fd = None
       self._write_fd = None
       self._thread = None
+      _STDERR_CAPTURE_LOCK.release()
+
+  def _drain(self, read_fd: int, orig_fd: int) -> None:
+    try:
+      while True:
+        try:
+          chunk = os.read(read_fd, 65536)
+        except OSError:
+          break
+        if not chunk:
+          break
+        self._buffer += chunk
+        try:
+          os.write(orig_fd, chunk)
+        except OSError:
+          pass
+    finally:
+      for fd in (read_fd, orig_fd):
+        try:
+          os.close(fd)
+        except OSError:
+          pass
 
   def get_text(self) -> str:
     if not self._buffer:
       return ""
     try:
-      return b"".join(self._buffer).decode("utf-8", errors="replace")
+      return self._buffer.decode("utf-8", errors="replace")
     except Exception:
       return ""
 
 
 # -------- record batch iterator via ConnectorX --------
 
-def _iter_record_batches(conn: str, sql_text: str, batch_size: int) -> Iterator[pa.RecordBatch]:
-  import connectorx as cx  # type: ignore
-  from urllib.parse import urlparse
-  
-  # Determine database type from the connection token scheme
-  parsed_conn = urlparse(conn)
-  db_type = (parsed_conn.scheme or "").lower()
-  
-  # Always use arrow_stream as requested; capture Rust panic output written to stderr
-  with _StderrCapture() as cap:
-    try:
-      stream = cx.read_sql(conn, sql_text, return_type="arrow_stream", batch_size=batch_size)
-    except BaseException as e:  # includes PanicException
-      msg = str(e)
-      stderr_txt = cap.get_text()
-      if stderr_txt:
-        msg = f"{msg}\n{stderr_txt}"
-      _handle_connectorx_error(msg, db_type)
-  
-  with _StderrCapture() as cap:
-    try:
-      for rb in stream:  # type: ignore
+def _detach_batch(batch: pa.RecordBatch) -> pa.RecordBatch:
+  """Return a copy of ``batch`` whose buffers are owned by PyArrow's memory pool.
+
+  Round-trips through the IPC stream format (one memcpy) so the ConnectorX-allocated
+  buffers can be freed as soon as the original batch is dropped, instead of living as
+  long as the copy downstream does.
+  """
+  sink = pa.BufferOutputStream()
+  with pa.ipc.new_stream(sink, batch.schema) as writer:
+    writer.write_batch(batch)
+  return pa.ipc.open_stream(sink.getvalue()).read_next_batch()
+
+
+# Vendors for which ConnectorX cannot partition a query; partition options are dropped
+_NO_PARTITION_VENDORS = ("bigquery",)
+
+
+def _iter_record_batches(
+  conn: str,
+  vendor: str,
+  sql_text: str,
+  batch_size: int,
+  partition_on: Optional[str] = None,
+  partition_num: Optional[int] = None,
+  detach: bool = False,
+) -> Iterator[pa.RecordBatch]:
+  partition_kwargs: dict[str, object] = {}
+  if partition_on and partition_num and not vendor.startswith(_NO_PARTITION_VENDORS):
+    partition_kwargs = {"partition_on": partition_on, "partition_num": partition_num}
+
+  # Always use arrow_stream as requested; capture Rust panic output written to stderr.
+  # One capture spans the whole query (read_sql and every next() on the stream), so a query
+  # pays for a single pipe and drainer thread however many batches it returns. This runs on
+  # the prefetch thread, so the capture overlaps the consumer's file writes; their stderr
+  # output is forwarded, not lost.
+  cap = _StderrCapture()
+  try:
+    with cap:
+      stream = cx.read_sql(conn, sql_text, return_type="arrow_stream", batch_size=batch_size, **partition_kwargs)
+      batch_iter = iter(stream)  # type: ignore
+      empty = True
+      while True:
+        rb = next(batch_iter, None)
+        if rb is None:
+          break
+        empty = False
         if not isinstance(rb, pa.RecordBatch):
           # Some ConnectorX back-ends may yield a pyarrow.Table instead; split into batches
           if isinstance(rb, pa.Table):
             for b in rb.to_batches(max_chunksize=batch_size):
-              yield b
+              yield _detach_batch(b) if detach else b
           else:
             raise RuntimeError("ConnectorX did not return RecordBatch or Table stream")
         else:
-          yield rb
-    except BaseException as e:  # includes PanicException during iteration
-      msg = str(e)
-      stderr_txt = cap.get_text()
-      if stderr_txt:
-        msg = f"{msg}\n{stderr_txt}"
-      _handle_connectorx_error(msg, db_type)
+          yield _detach_batch(rb) if detach else rb
+        del rb
+  except GeneratorExit:
+    raise
+  except BaseException as e:  # includes PanicException
+    msg = str(e)
+    stderr_txt = cap.get_text()
+    if stderr_txt:
+      msg = f"{msg}\n{stderr_txt}"
+    _handle_connectorx_error(msg, vendor)
 
-# -------- MCP server --------
+  # Empty result: hand the stream's schema downstream as a zero-row batch so the writers
+  # still emit the column names and types (without re-running the query)
+  schema = getattr(stream, "schema", None)
+  if empty and isinstance(schema, pa.Schema):
+    yield pa.RecordBatch.from_pylist([], schema=schema)
 
-def run_server(conn: str, csv_token_threshold: int = 0) -> None:
-  import asyncio
-  from mcp.server import Server  # type: ignore
-  import mcp.server.stdio  # type: ignore
-  import mcp.types as types  # type: ignore
-  from mcp.server.models import InitializationOptions  # type: ignore
-  from mcp.server import NotificationOptions  # type: ignore
 
+# -------- background prefetch (overlap DB fetch with file encoding) --------
+
+_PREFETCH_DONE = object()
+
+
+def _prefetch(iterator: Iterator[pa.RecordBatch], maxsize: int = 2) -> Iterator[pa.RecordBatch]:
+  """Drive ``iterator`` on a background thread and yield its items on the caller's thread.
+
+  ConnectorX decodes in Rust and PyArrow encodes in C++, both with the GIL released, so
+  fetching the next batch while the current one is being written gives real overlap. The
+  queue is bounded to keep at most ``maxsize`` batches in flight; exceptions raised by the
+  producer are re-raised in the consumer. Closing the generator stops the producer and
+  joins its thread, so nothing is left running inside ConnectorX once the caller is done.
+  """
+  q: "queue.Queue[tuple[object, Optional[BaseException]]]" = queue.Queue(maxsize=maxsize)
+  stop = threading.Event()
+
+  def _put(item: object, exc: Optional[BaseException] = None) -> bool:
+    while not stop.is_set():
+      try:
+        q.put((item, exc), timeout=0.1)
+        return True
+      except queue.Full:
+        continue
+    return False
+
+  def _producer() -> None:
+    try:
+      for item in iterator:
+        if not _put(item):
+          break
+      else:
+        _put(_PREFETCH_DONE)
+    except BaseException as e:  # includes PanicException
+      _put(None, e)
+    finally:
+      close = getattr(iterator, "close", None)
+      if close is not None:
+        try:
+          close()
+        except Exception:
+          pass
+
+  thread = threading.Thread(target=_producer, daemon=True)
+  thread.start()
+  try:
+    while True:
+      item, exc = q.get()
+      if exc is not None:
+        raise exc
+      if item is _PREFETCH_DONE:
+        return
+      yield item  # type: ignore[misc]
+      del item
+  finally:
+    stop.set()
+    # Free queued batches (and a producer blocked on a full queue), then wait for the
+    # producer to leave ConnectorX; it notices stop at its next put
+    _drain_queue(q)
+    thread.join()
+    _drain_queue(q)
+
+
+def _drain_queue(q: "queue.Queue[tuple[object, Optional[BaseException]]]") -> None:
+  while True:
+    try:
+      q.get_nowait()
+    except queue.Empty:
+      return
+
+
+def _chain_first(first: pa.RecordBatch, rest: Iterator[pa.RecordBatch]) -> Iterator[pa.RecordBatch]:
+  """Yield a peeked ``first`` batch followed by ``rest``.
+
+  Unlike itertools.chain, which keeps its arguments until the stream is exhausted, this
+  drops ``first`` as soon as the writer asks for the next batch.
+  """
+  yield first
+  del first
+  yield from rest
+
+
+# -------- MCP server --------
+
+def run_server(conn: str, csv_token_threshold: int = 0, detach_batches: bool = False) -> None:
   server = Server("run-sql-connectorx")
   run_server._conn = conn  # type: ignore
+  # Resolve the vendor once; reused by every tool call
+  run_server._vendor = (urlparse(conn).scheme or "").lower()  # type: ignore
   run_server._csv_token_threshold = int(csv_token_threshold)  # type: ignore
+  run_server._detach_batches = bool(detach_batches)  # type: ignore
   run_server._eager_connect = True  # type: ignore  # Always perform an eager connection check
+  if run_server._csv_token_threshold > 0:  # type: ignore
+    _get_encoder("o200k_base")  # load once at startup rather than on the first CSV call
 
   def tool_spec():
     return types.Tool(
       name="run_sql",
-      description="Execute SQL via ConnectorX and write to CSV/Parquet (token-efficient: data is exchanged via files, not inline).",
+      description="Execute SQL via ConnectorX and write to CSV/Parquet/Arrow IPC (token-efficient: data is exchanged via files, not inline).",
       inputSchema={
         "type": "object",
         "properties": {
           "sql_file": {"type": "string"},
           "output_path": {"type": "string"},
-          "output_format": {"type": "string", "enum": ["csv", "parquet"]},
+          "output_format": {"type": "string", "enum": ["csv", "parquet", "arrow"]},
           "batch_size": {"type": "integer"},
+          "partition_on": {"type": "string"},
+          "partition_num": {"type": "integer"},
         },
         "required": ["sql_file", "output_path", "output_format"],
       },
     )
 
+  # The tool schema and the fixed replies never change; build them once per server
+  tools = [tool_spec()]
+  ok_response = [types.TextContent(type="text", text="OK")]
+  unknown_tool_response = [types.TextContent(type="text", text="Unknown tool")]
+  missing_arguments_response = [types.TextContent(type="text", text="Missing arguments")]
+
   @server.list_tools()
   async def handle_list_tools() -> list[types.Tool]:
-    return [tool_spec()]
+    return tools
 
   @server.call_tool()
   async def handle_call_tool(name: str, arguments: dict | None) -> list[types.TextContent]:
     if name != "run_sql":
-      return [types.TextContent(type="text", text="Unknown tool")]
+      return unknown_tool_response
     if not arguments:
-      return [types.TextContent(type="text", text="Missing arguments")]
+      return missing_arguments_response
     try:
       sql_file = arguments.get("sql_file")
       output_path = arguments.get("output_path")
       output_format = arguments.get("output_format")
       batch_size = int(arguments.get("batch_size", 100000))
-      if not sql_file or not output_path or output_format not in ("csv", "parquet"):
+      partition_on = arguments.get("partition_on")
+      partition_num = arguments.get("partition_num")
+      partition_num = int(partition_num) if partition_num is not None else None
+      if not sql_file or not output_path or output_format not in ("csv", "parquet", "arrow"):
         raise ValueError("invalid arguments")
 
-      sql_text = Path(sql_file).read_text(encoding="utf-8")
-      if not sql_text.strip():
+      # Read raw bytes: skips read_text's universal-newline scan, and empty/whitespace-only
+      # files are rejected (one scan, no copy) before paying for the UTF-8 decode ConnectorX needs
+      sql_bytes = Path(sql_file).read_bytes()
+      if not sql_bytes or sql_bytes.isspace():
         raise ValueError("sql is empty")
+      sql_text = sql_bytes.decode("utf-8")
 
       out = Path(output_path)
       out.parent.mkdir(parents=True, exist_ok=True)
@@ -286,48 +702,60 @@ def run_server(conn: str, csv_token_threshold: int = 0) -> None:
         out.unlink()
 
       # Retrieve data via ConnectorX
-      batches = _iter_record_batches(run_server._conn, sql_text, batch_size)  # type: ignore
-      
-      if output_format == "csv":
-        # Always write the header row when there is at least one batch
-        first = next(batches, None)
-        threshold = max(0, int(getattr(run_server, "_csv_token_threshold", 0)))  # type: ignore
-        if first is None:
-          # Empty result set: create an empty file (no column info available)
-          with out.open("w", newline="", encoding="utf-8") as fp:
-            pass
-          if threshold > 0:
-            return [types.TextContent(type="text", text="OK 0 tokens")]
-        else:
-          header = [f.name for f in first.schema]
-          def chain_batches():
-            yield first
-            for b in batches:
-              yield b
-          if threshold > 0:
-            import tiktoken  # type: ignore
-            encoder = tiktoken.get_encoding("o200k_base")
-            total_tokens = _write_csv_batches(header, chain_batches(), out, encoder=encoder)
-            if total_tokens >= threshold:
-              return [types.TextContent(type="text", text=f"OK {total_tokens} tokens. Too many tokens may impair processing. Handle appropriately")]
-            else:
-              return [types.TextContent(type="text", text=f"OK {total_tokens} tokens")]
+      batches = _prefetch(
+        _iter_record_batches(
+          run_server._conn,  # type: ignore
+          run_server._vendor,  # type: ignore
+          sql_text,
+          batch_size,
+          partition_on=partition_on,
+          partition_num=partition_num,
+          detach=run_server._detach_batches,  # type: ignore
+        )
+      )
+      try:
+        if output_format == "csv":
+          # Always write the header row when there is at least one batch
+          first = next(batches, None)
+          threshold = max(0, int(getattr(run_server, "_csv_token_threshold", 0)))  # type: ignore
+          if first is None:
+            # Stream without a schema: create an empty file (no column info available)
+            pa.OSFile(str(out), "wb").close()
+            if threshold > 0:
+              return [types.TextContent(type="text", text="OK 0 tokens")]
           else:
-            _write_csv_batches(header, chain_batches(), out, encoder=None)
-      else:
-        # Parquet: write an empty table when the result set is empty
-        first = next(batches, None)
-        if first is None:
-          table = pa.table({})
-          pq.write_table(table, out)
+            # Re-attach the peeked batch; the generator holds its only reference from here on
+            all_batches, first = _chain_first(first, batches), None
+            _write_csv_batches(all_batches, out, batch_size)
+            if threshold > 0:
+              total_tokens = _count_csv_tokens(out, _get_encoder("o200k_base"))
+              if total_tokens >= threshold:
+                return [types.TextContent(type="text", text=f"OK {total_tokens} tokens. Too many tokens may impair processing. Handle appropriately")]
+              else:
+                return [types.TextContent(type="text", text=f"OK {total_tokens} tokens")]
+        elif output_format == "parquet":
+          # Parquet: write an empty table when the stream carries no schema
+          first = next(batches, None)
+          if first is None:
+            table = pa.table({})
+            pq.write_table(table, out)
+          else:
+            all_batches, first = _chain_first(first, batches), None
+            _write_parquet_batches(all_batches, out, batch_size)
         else:
-          def chain_batches():
-            yield first
-            for b in batches:
-              yield b
-          _write_parquet_batches(chain_batches(), out)
+          # Arrow IPC: write an empty (schema-less) file when the stream carries no schema
+          first = next(batches, None)
+          if first is None:
+            with pa.OSFile(str(out), "wb") as sink:
+              pa.ipc.new_file(sink, pa.schema([])).close()
+          else:
+            all_batches, first = _chain_first(first, batches), None
+            _write_arrow_batches(all_batches, out)
+      finally:
+        # Stop and join the prefetch thread before returning, also when a writer failed
+        batches.close()
 
-      return [types.TextContent(type="text", text="OK")]
+      return ok_response
     except BaseException as e:
       # Cleanup any partial output on failure
       try:
@@ -339,11 +767,13 @@ def run_server(conn: str, csv_token_threshold: int = 0) -> None:
       # Build a detailed error message based on the error category
       # Always return the original message as-is for maximum transparency and future-proofing
       detailed_msg = str(e)
-      
-      # Print traceback for debugging
-      import traceback
-      print(f"Full traceback:\n{traceback.format_exc()}", file=sys.stderr)
-      
+
+      # Full traceback only when debugging; otherwise a single line without formatting frames
+      if os.environ.get("MCP_DEBUG") == "1":
+        print(f"Full traceback:\n{traceback.format_exc()}", file=sys.stderr)
+      else:
+        print(f"run_sql failed: {e!r}", file=sys.stderr)
+
       return [types.TextContent(type="text", text=f"Error: {detailed_msg}")]
 
   def run_sync():
@@ -358,18 +788,12 @@ def run_server(conn: str, csv_token_threshold: int = 0) -> None:
             capabilities=server.get_capabilities(notification_options=NotificationOptions(), experimental_capabilities={}),
           ),
         )
-    import asyncio
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
     try:
-      loop.run_until_complete(run_async())
+      asyncio.run(run_async())
     except Exception as e:
-      import traceback, sys as _sys
-      print(f"Server initialization error: {e}", file=_sys.stderr)
+      print(f"Server initialization error: {e}", file=sys.stderr)
       traceback.print_exc()
       raise
-    finally:
-      loop.close()
 
   run_sync()
 
@@ -381,8 +805,6 @@ def _validate_connection(conn: str) -> None:
   * SQLite     – Validate in-memory or file path usage
   * Others     – Basic connection-token structure check and connection test
   """
-  from urllib.parse import urlparse, parse_qsl
-
   parsed = urlparse(conn)
   vendor = (parsed.scheme or "").lower()
 
@@ -417,8 +839,10 @@ def _validate_connection(conn: str) -> None:
 
   # Perform a real connection test (common to all vendors)
   try:
-    import connectorx as cx  # type: ignore
-    result = cx.read_sql(conn, "SELECT 1", return_type="arrow")  # type: ignore
+    # Stream the probe and stop after the first batch instead of materializing a Table
+    stream = cx.read_sql(conn, "SELECT 1", return_type="arrow_stream")  # type: ignore
+    for _ in stream:
+      break
   except Exception as conn_exc:
     # Use the shared error handler
     _handle_connectorx_error(str(conn_exc), vendor)
@@ -427,9 +851,15 @@ def _validate_connection(conn: str) -> None:
 def main() -> None:
   args = _parse_args()
   try:
+    if _IMPORT_ERROR is not None:
+      raise RuntimeError(f"Missing dependency: {_IMPORT_ERROR}")
     # Validate database connection before starting the MCP server
     _validate_connection(args.conn)
-    run_server(conn=args.conn, csv_token_threshold=getattr(args, "csv_token_threshold", 0))
+    run_server(
+      conn=args.conn,
+      csv_token_threshold=getattr(args, "csv_token_threshold", 0),
+      detach_batches=getattr(args, "detach_batches", False),
+    )
   except Exception as exc:
     print(f"Error: {exc}", file=sys.stderr)
     print(f"\n{DOC_USAGE}", file=sys.stderr)